@@ -7,13 +7,23 @@ modified using the template at https://codepen.io/Devel0per95/pen/rjOpdx
 """
 
 from flask import Flask, g, render_template, request, redirect, url_for, \
-    jsonify, session
+    jsonify, session, send_from_directory, abort
 import os
+from concurrent.futures import ThreadPoolExecutor
 from blog_db import BlogPost
+from blog_images import PILLOW_AVAILABLE, allowed_image, save_upload, \
+    generate_variants, group_variants, group_variants_by_blog
 
 app = Flask(__name__)
 app.secret_key = 'generic_secret_key'
 app.config['DATABASE'] = os.path.join(app.root_path, 'blog.sqlite')
+app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# A variant is written once and never replaced, so browsers can keep it.
+app.config['UPLOAD_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# Resizing images is slow, so it is done here rather than in the request.
+image_workers = ThreadPoolExecutor(max_workers=2)
 
 
 def get_db():
@@ -27,6 +37,34 @@ def get_db():
     return g.blog_db
 
 
+def log_variant_failure(future):
+    """
+    Done-callback for the image workers. Exceptions raised on a worker thread
+    are otherwise kept in the future and never seen, so they are logged here.
+
+    :param future: the finished Future of a generate_variants() call
+    """
+    error = future.exception()
+    if error is not None:
+        app.logger.error('Generating image variants failed',
+                         exc_info=(type(error), error, error.__traceback__))
+
+
+@app.template_filter('srcset')
+def srcset(images):
+    """
+    Given a list of image variants of one kind and format, build the value
+    of a srcset attribute, e.g. '/uploads/1/header-480.webp 480w, ...'.
+
+    :param images: a list of dicts representing image variants
+    :return: the srcset string
+    """
+    return ', '.join('{} {}w'.format(url_for('uploaded_image',
+                                              filename=image['filename']),
+                                      image['width'])
+                     for image in images)
+
+
 @app.before_request
 def before_request():
     """
@@ -124,6 +162,10 @@ def index():
     :return: HTML page for index.
     """
     posts = get_db().get_all_posts()
+    thumbs = group_variants_by_blog(get_db().get_images_by_kind('thumb'))
+    for blog in posts:
+        blog['thumb'] = thumbs.get(blog['id'], {}).get('thumb')
+
     return render_template('index.html', posts=posts)
 
 
@@ -136,7 +178,25 @@ def post(post_id):
     :return: HTML of the specific post
     """
     to_post = get_db().get_blog_by_id(post_id)
-    return render_template('post.html', post=to_post)
+    images = group_variants(get_db().get_images_by_blog_id(post_id))
+    return render_template('post.html', post=to_post,
+                           header=images.get('header'))
+
+
+@app.route('/uploads/<path:filename>')
+def uploaded_image(filename):
+    """
+    Implements GET /uploads/:filename. Serves the resized image variants from
+    the upload folder. The uploaded originals are not served.
+
+    :param filename: path of the variant relative to the upload folder
+    :return: the image file
+    """
+    if os.path.basename(filename).startswith('original-'):
+        abort(404)
+
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                               max_age=app.config['UPLOAD_MAX_AGE'])
 
 
 @app.route('/add')
@@ -146,7 +206,7 @@ def add():
 
     :return: HTML of the page where blog data is entered
     """
-    return render_template('add.html')
+    return render_template('add.html', images_enabled=PILLOW_AVAILABLE)
 
 
 @app.route('/addpost', methods=['POST'])
@@ -155,12 +215,26 @@ def addpost():
     Implements POST /post
 
     Requires the blog-form parameters 'title', 'subtitle', and 'content'. The
-    parameter for user name is a part of the user session.
+    parameter for user name is a part of the user session. An optional header
+    image can be uploaded as 'image' when Pillow is installed; it is saved
+    right away and its resized variants are made in the background.
 
     :return: HTML of the index after post has been made.
     """
-    get_db().insert_blog(request.form['title'], request.form['subtitle'],
-                         session['user_id'], request.form['content'])
+    blog = get_db().insert_blog(request.form['title'],
+                                request.form['subtitle'],
+                                session['user_id'], request.form['content'])
+
+    upload = request.files.get('image')
+    if blog is not False and PILLOW_AVAILABLE and upload \
+            and allowed_image(upload.filename):
+        original = save_upload(upload, app.config['UPLOAD_FOLDER'],
+                               blog['blog_id'])
+        future = image_workers.submit(generate_variants,
+                                      app.config['DATABASE'],
+                                      blog['blog_id'], original,
+                                      app.config['UPLOAD_FOLDER'])
+        future.add_done_callback(log_variant_failure)
 
     return redirect(url_for('index'))
 
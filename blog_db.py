@@ -55,6 +55,8 @@ class BlogPost:
         if create_tables:
             self.create_tables()
 
+        self.create_image_table()
+
     def create_tables(self):
         """
         Create the tables blog, author and password.
@@ -76,6 +78,26 @@ class BlogPost:
 
         self.conn.commit()
 
+    def create_image_table(self):
+        """
+        Create the table image, which holds the resized variants generated
+        for the header image of a post. Unlike the other tables this is also
+        created for databases that existed before image uploads were added.
+        """
+
+        cur = self.conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS image('
+                    '    image_id INTEGER PRIMARY KEY, blog_id INTEGER, '
+                    '    kind TEXT, format TEXT, width INTEGER, '
+                    '    height INTEGER, filename TEXT, '
+                    'FOREIGN KEY (blog_id) REFERENCES blog(blog_id)) ')
+
+        # Every post page looks up the variants of its blog.
+        cur.execute('CREATE INDEX IF NOT EXISTS image_blog_id '
+                    'ON image(blog_id) ')
+
+        self.conn.commit()
+
     def insert_blog(self, title, subtitle, author, content):
         """
         Inserts a blog into the database. If the author is not already in
@@ -123,6 +145,85 @@ class BlogPost:
         cur.execute(query, (blog_id,))
         return row_to_dict_or_false(cur)
 
+    def insert_images(self, blog_id, variants):
+        """
+        Inserts all of the resized image variants of a blog into the database
+        in a single transaction, so that a post is never seen with only some
+        of its variants. If the blog is not already in database, nothing is
+        inserted and it returns False.
+
+        Each variant is a (kind, image_format, width, height, filename)
+        tuple: kind is what the variant is used for, 'header' or 'thumb';
+        image_format is 'webp' or 'jpeg'; width and height are in pixels; and
+        filename is the path of the variant relative to the upload folder.
+
+        :param blog_id: blog_id of the post the images belong to
+        :param variants: a list of variant tuples
+        :return: a list of dicts representing the images of the blog or False
+        """
+
+        try:
+            cur = self.conn.cursor()
+            query = ('INSERT INTO image(blog_id, kind, format, width, height, '
+                     '                  filename) '
+                     'VALUES(?, ?, ?, ?, ?, ?) ')
+            cur.executemany(query, [(blog_id,) + tuple(variant)
+                                    for variant in variants])
+            self.conn.commit()
+
+        except IntegrityError:
+            self.conn.rollback()
+            return False
+
+        return self.get_images_by_blog_id(blog_id)
+
+    def get_images_by_blog_id(self, blog_id):
+        """
+        Return a list of dictionaries representing all of the image variants
+        of a blog post, from the narrowest to the widest.
+
+        :param blog_id: blog_id for a post
+        :return: a list of dict objects representing image variants
+        """
+        cur = self.conn.cursor()
+        query = ('SELECT image_id, blog_id, kind, format, width, height, '
+                 '       filename '
+                 'FROM image '
+                 'WHERE image.blog_id = ? '
+                 'ORDER BY width ')
+
+        images = []
+        cur.execute(query, (blog_id,))
+
+        for row in cur.fetchall():
+            images.append(dict(row))
+
+        return images
+
+    def get_images_by_kind(self, kind):
+        """
+        Return a list of dictionaries representing the image variants of the
+        given kind for every post, so that the index can be built without a
+        query per post.
+
+        :param kind: what the variant is used for, 'header' or 'thumb'
+        :return: a list of dict objects representing image variants
+        """
+        cur = self.conn.cursor()
+        query = ('SELECT image_id, blog_id, kind, format, width, height, '
+                 '       filename '
+                 'FROM image '
+                 'WHERE image.kind = ? '
+                 'ORDER BY blog_id, width ')
+
+        images = []
+        cur.execute(query, (kind,))
+
+        for row in cur.fetchall():
+            images.append(dict(row))
+
+        return images
+
     def get_all_posts(self):
         """
         Return a list of dictionaries representing all of the posts in the blog
@@ -0,0 +1,254 @@
+"""
+Header image uploads for blog posts.
+
+An upload is streamed to disk in chunks by save_upload() while the request is
+being handled. The resized variants are made afterwards by
+generate_variants(), which is meant to be run on a background worker so that
+posting returns immediately. Every variant is recorded in the image table so
+that the templates can emit srcset attributes and let the browser download
+the smallest adequate file.
+
+Image uploads need the Pillow package; see PILLOW_AVAILABLE.
+"""
+
+import os
+import secrets
+from blog_db import BlogPost
+
+# Pillow is optional: without it the blog still runs, but image uploads are
+# turned off.
+try:
+    from PIL import Image, ImageOps, features
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+CHUNK_SIZE = 64 * 1024
+
+# Widths in pixels of the variants made for each kind of image. Headers span
+# the full page width, thumbnails are shown at 160px on the index cards.
+VARIANT_WIDTHS = {
+    'header': (480, 960, 1600),
+    'thumb': (160, 320),
+}
+
+# Larger originals are rejected before they are decoded. The byte limit on
+# uploads does not help here, since a huge plain image compresses very well.
+MAX_PIXELS = 40 * 1000 * 1000
+
+# EXIF orientations for which exif_transpose() turns the image sideways.
+EXIF_ORIENTATION = 0x0112
+SIDEWAYS_ORIENTATIONS = (5, 6, 7, 8)
+
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+
+
+def allowed_image(filename):
+    """
+    Given the name of an uploaded file, check whether its extension is one of
+    the accepted image formats.
+
+    :param filename: name of the uploaded file
+    :return: True if the file looks like an accepted image
+    """
+    return '.' in filename and \
+        filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def save_upload(upload, upload_dir, blog_id):
+    """
+    Write an uploaded file to disk a chunk at a time, so that large images are
+    never held in memory as a whole. The file is stored under a random name
+    inside a directory for the post.
+
+    :param upload: a FileStorage object from request.files
+    :param upload_dir: directory that holds the uploads of every post
+    :param blog_id: blog_id of the post the image belongs to
+    :return: path of the saved original
+    """
+    post_dir = os.path.join(upload_dir, str(blog_id))
+    os.makedirs(post_dir, exist_ok=True)
+
+    extension = upload.filename.rsplit('.', 1)[1].lower()
+    path = os.path.join(post_dir, 'original-{}.{}'.format(
+        secrets.token_hex(8), extension))
+
+    with open(path, 'wb') as out:
+        while True:
+            chunk = upload.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+
+    return path
+
+
+def variant_formats():
+    """
+    Return the formats the variants are saved in, preferred format first.
+    WebP is skipped when Pillow was built without support for it.
+
+    :return: a list of format names
+    """
+    if features.check('webp'):
+        return ['webp', 'jpeg']
+    return ['jpeg']
+
+
+def flatten(image):
+    """
+    Convert an image to RGB for saving as JPEG. Transparent areas are put
+    on a white background, since plain conversion would turn them black.
+
+    :param image: a Pillow Image in any mode
+    :return: an RGB Image
+    """
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        return Image.alpha_composite(background, image).convert('RGB')
+
+    return image.convert('RGB')
+
+
+def shrink(image):
+    """
+    Shrink a freshly opened image in place so that it is no wider than the
+    widest variant once exif_transpose() has turned it upright. This is done
+    before the image is decoded in full, so JPEGs are decoded at a reduced
+    scale and the later copies made while flattening stay small.
+
+    :param image: a Pillow Image that has been opened but not yet loaded
+    """
+    largest = max(max(widths) for widths in VARIANT_WIDTHS.values())
+
+    # Palette images can only be resized with NEAREST, so they are left at
+    # twice the size and the LANCZOS resizes of the variants do the rest.
+    if image.mode == 'P':
+        largest *= 2
+
+    if image.getexif().get(EXIF_ORIENTATION) in SIDEWAYS_ORIENTATIONS:
+        image.thumbnail((image.width, largest))
+    else:
+        image.thumbnail((largest, image.height))
+
+
+def generate_variants(db_path, blog_id, original_path, upload_dir):
+    """
+    Make the resized header and thumbnail variants of an uploaded original
+    and record them in the database. Images are never scaled up, so a small
+    original yields a single variant per kind and format. An original that
+    cannot be decoded, or has more than MAX_PIXELS pixels, is deleted. This
+    runs on a worker thread and therefore opens its own database connection.
+
+    :param db_path: path of the SQLite database file
+    :param blog_id: blog_id of the post the image belongs to
+    :param original_path: path of the original saved by save_upload()
+    :param upload_dir: directory that holds the uploads of every post
+    :return: a list of dicts representing the variants, or False if the
+    original could not be used as an image or the post no longer exists
+    """
+    try:
+        with Image.open(original_path) as original:
+            if original.width * original.height <= MAX_PIXELS:
+                # The colour profile is kept so wide-gamut photos do not look
+                # washed out, but only an RGB one still fits after flatten().
+                icc_profile = None
+                if original.mode in ('RGB', 'RGBA', 'P'):
+                    icc_profile = original.info.get('icc_profile')
+                shrink(original)
+                original = flatten(ImageOps.exif_transpose(original))
+            else:
+                original = None
+    except (OSError, Image.DecompressionBombError):
+        original = None
+
+    if original is None:
+        # Not an image we can use, so there is no reason to keep it around.
+        os.remove(original_path)
+        return False
+
+    post_dir = os.path.join(upload_dir, str(blog_id))
+    variants = []
+
+    # Every width is resized from the next larger one rather than from the
+    # original, widest first, and widths shared by several kinds only once.
+    resized_by_width = {}
+    source = original
+    for width in sorted({min(width, original.width)
+                         for widths in VARIANT_WIDTHS.values()
+                         for width in widths}, reverse=True):
+        if width != source.width:
+            height = round(original.height * width / original.width)
+            source = source.resize((width, height), Image.LANCZOS)
+        resized_by_width[width] = source
+
+    for kind, widths in VARIANT_WIDTHS.items():
+        made = set()
+        for width in widths:
+            width = min(width, original.width)
+            if width in made:
+                continue
+            made.add(width)
+            resized = resized_by_width[width]
+            height = resized.height
+
+            for image_format in variant_formats():
+                extension = 'jpg' if image_format == 'jpeg' else image_format
+                name = '{}-{}.{}'.format(kind, width, extension)
+                path = os.path.join(post_dir, name)
+                if image_format == 'webp':
+                    resized.save(path, 'WEBP', quality=WEBP_QUALITY,
+                                 icc_profile=icc_profile)
+                else:
+                    resized.save(path, 'JPEG', quality=JPEG_QUALITY,
+                                 optimize=True, progressive=True,
+                                 icc_profile=icc_profile)
+
+                # Stored relative to the upload folder, as a URL path.
+                filename = '{}/{}'.format(blog_id, name)
+                variants.append((kind, image_format, width, height, filename))
+
+    # The variants are only recorded once every file has been written, and
+    # all at once, so readers never see a post with half of its variants.
+    db = BlogPost(db_path)
+    try:
+        return db.insert_images(blog_id, variants)
+    finally:
+        db.conn.close()
+
+
+def group_variants(images):
+    """
+    Given a list of image variants, group them by kind and then by format so
+    that a template can look up e.g. the WebP headers of a post.
+
+    :param images: a list of dicts representing image variants
+    :return: a dict of the form {kind: {format: [image, ...]}}
+    """
+    grouped = {}
+
+    for image in images:
+        formats = grouped.setdefault(image['kind'], {})
+        formats.setdefault(image['format'], []).append(image)
+
+    return grouped
+
+
+def group_variants_by_blog(images):
+    """
+    Given a list of image variants of many posts, group them by blog_id and
+    then as in group_variants().
+
+    :param images: a list of dicts representing image variants
+    :return: a dict of the form {blog_id: {kind: {format: [image, ...]}}}
+    """
+    by_blog = {}
+
+    for image in images:
+        by_blog.setdefault(image['blog_id'], []).append(image)
+
+    return {blog_id: group_variants(blog_images)
+            for blog_id, blog_images in by_blog.items()}
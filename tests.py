@@ -1,3 +1,11 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import blog_images
 from blog_db import BlogPost
 
 
@@ -12,6 +20,61 @@ def build_db_path(directory):
     return directory / 'test.sqlite'
 
 
+def build_image(width, height, mode='RGB', color=(200, 30, 30)):
+    """
+    Build an in-memory PNG of the given size for upload tests.
+
+    :param width: width of the image in pixels
+    :param height: height of the image in pixels
+    :param mode: Pillow mode of the image
+    :param color: fill color of the image
+    :return: the PNG file contents as bytes
+    """
+    image_module = pytest.importorskip('PIL.Image')
+    data = io.BytesIO()
+    image_module.new(mode, (width, height), color).save(data, 'PNG')
+    return data.getvalue()
+
+
+def build_original(tmp_path, data, name='original-test.png'):
+    """
+    Write an uploaded original for post 1 into an upload folder inside the
+    temporary directory, as save_upload() would.
+
+    :param tmp_path: a Path object representing the temporary directory
+    :param data: the file contents as bytes
+    :param name: name of the original
+    :return: a tuple of the upload folder and the path of the original
+    """
+    upload_dir = tmp_path / 'uploads'
+    (upload_dir / '1').mkdir(parents=True)
+    original = upload_dir / '1' / name
+    original.write_bytes(data)
+    return upload_dir, original
+
+
+def build_app(tmp_path, monkeypatch):
+    """
+    Import the Flask app and point it at a database and upload folder inside
+    the temporary directory. The image workers are replaced with a fresh
+    pool, so that a test can wait for them by shutting it down.
+
+    :param tmp_path: a Path object representing the temporary directory
+    :param monkeypatch: the pytest monkeypatch fixture
+    :return: the blog_app module
+    """
+    pytest.importorskip('flask')
+    import blog_app
+
+    monkeypatch.setitem(blog_app.app.config, 'DATABASE',
+                        str(build_db_path(tmp_path)))
+    monkeypatch.setitem(blog_app.app.config, 'UPLOAD_FOLDER',
+                        str(tmp_path / 'uploads'))
+    monkeypatch.setattr(blog_app, 'image_workers',
+                        ThreadPoolExecutor(max_workers=1))
+    return blog_app
+
+
 def test_initializer(tmp_path):
     """
     Test that the BlogPost initializer runs without errors.
@@ -210,3 +273,404 @@ def test_get_all_posts(tmp_path):
 
     blogs = db.get_all_posts()
     assert len(blogs) == 2
+
+
+def test_get_images_by_blog_id(tmp_path):
+    """
+    Test that get_images_by_blog_id() returns an empty list for a post
+    without images, and returns the variants of a post ordered by width.
+    """
+
+    db = BlogPost(build_db_path(tmp_path))
+
+    assert db.sign_up_entry('KHANDOKAR', 'PASSWORD')
+    blog_1 = db.insert_blog('STITLE', 'SSUBTITLE', 'KHANDOKAR', 'SCONTENT')
+    blog_2 = db.insert_blog('title', 'sub', 'KHANDOKAR', 'content')
+
+    assert db.get_images_by_blog_id(blog_1['blog_id']) == []
+
+    assert db.insert_images(blog_1['blog_id'],
+                            [('header', 'jpeg', 960, 540, '1/header-960.jpg'),
+                             ('thumb', 'jpeg', 160, 90, '1/thumb-160.jpg')])
+    assert db.insert_images(blog_2['blog_id'],
+                            [('thumb', 'jpeg', 160, 90, '2/thumb-160.jpg')])
+
+    images = db.get_images_by_blog_id(blog_1['blog_id'])
+    assert len(images) == 2
+    assert [image['width'] for image in images] == [160, 960]
+
+
+def test_image_blog_id_index(tmp_path):
+    """
+    Test that variants are looked up by blog_id through an index rather than
+    a scan of the image table.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    db = BlogPost(build_db_path(tmp_path))
+
+    cur = db.conn.cursor()
+    cur.execute('EXPLAIN QUERY PLAN '
+                'SELECT image_id FROM image WHERE image.blog_id = ? ', (1,))
+    plan = ' '.join(row['detail'] for row in cur.fetchall())
+    assert 'image_blog_id' in plan
+
+
+def test_get_images_by_kind(tmp_path):
+    """
+    Test that get_images_by_kind() returns only the variants of the given
+    kind, for every post.
+    """
+
+    db = BlogPost(build_db_path(tmp_path))
+
+    assert db.get_images_by_kind('thumb') == []
+    assert db.sign_up_entry('KHANDOKAR', 'PASSWORD')
+    blog_1 = db.insert_blog('STITLE', 'SSUBTITLE', 'KHANDOKAR', 'SCONTENT')
+    blog_2 = db.insert_blog('title', 'sub', 'KHANDOKAR', 'content')
+
+    assert db.insert_images(blog_1['blog_id'],
+                            [('header', 'jpeg', 960, 540, '1/header-960.jpg'),
+                             ('thumb', 'jpeg', 160, 90, '1/thumb-160.jpg')])
+    assert db.insert_images(blog_2['blog_id'],
+                            [('thumb', 'jpeg', 160, 90, '2/thumb-160.jpg')])
+
+    thumbs = db.get_images_by_kind('thumb')
+    assert len(thumbs) == 2
+    assert all(image['kind'] == 'thumb' for image in thumbs)
+
+
+def test_insert_images(tmp_path):
+    """
+    Test that insert_images() inserts every variant of a blog and returns
+    them, and that it inserts nothing and returns False for a blog that does
+    not exist.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    db = BlogPost(build_db_path(tmp_path))
+
+    assert db.sign_up_entry('Giraffe', 'animal')
+    blog = db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    images = db.insert_images(blog['blog_id'],
+                              [('header', 'jpeg', 960, 540, '1/header-960.jpg'),
+                               ('thumb', 'jpeg', 160, 90, '1/thumb-160.jpg')])
+
+    assert len(images) == 2
+    assert images == db.get_images_by_blog_id(blog['blog_id'])
+
+    header = images[1]
+    assert header['blog_id'] == blog['blog_id']
+    assert header['kind'] == 'header'
+    assert header['format'] == 'jpeg'
+    assert header['width'] == 960
+    assert header['height'] == 540
+    assert header['filename'] == '1/header-960.jpg'
+
+    assert db.insert_images(23, [('thumb', 'jpeg', 160, 90, 'x.jpg')]) is False
+    assert db.get_images_by_blog_id(23) == []
+
+
+def test_allowed_image():
+    """
+    Test that allowed_image() accepts the image extensions in any case and
+    rejects other files.
+    """
+    assert blog_images.allowed_image('photo.jpg')
+    assert blog_images.allowed_image('photo.final.PNG')
+    assert blog_images.allowed_image('photo.webp')
+    assert not blog_images.allowed_image('script.py')
+    assert not blog_images.allowed_image('jpg')
+
+
+def test_save_upload(tmp_path):
+    """
+    Test that save_upload() copies the whole upload to disk without reading
+    more than CHUNK_SIZE bytes at a time.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    data = os.urandom(blog_images.CHUNK_SIZE * 3 + 10)
+    reads = []
+
+    class RecordingStream(io.BytesIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super().read(size)
+
+    upload = SimpleNamespace(filename='photo.JPG',
+                             stream=RecordingStream(data))
+    path = blog_images.save_upload(upload, str(tmp_path / 'uploads'), 7)
+
+    assert os.path.dirname(path) == str(tmp_path / 'uploads' / '7')
+    assert os.path.basename(path).startswith('original-')
+    assert path.endswith('.jpg')
+    with open(path, 'rb') as saved:
+        assert saved.read() == data
+    assert all(0 < size <= blog_images.CHUNK_SIZE for size in reads)
+    assert len(reads) > 1
+
+
+def test_generate_variants(tmp_path):
+    """
+    Test that generate_variants() writes and records every variant in each
+    format, caps the widths at the width of the original, and stores the
+    filenames relative to the upload folder.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    upload_dir, original = build_original(tmp_path, build_image(1000, 500))
+
+    images = blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                           str(original), str(upload_dir))
+
+    formats = blog_images.variant_formats()
+    assert images == db.get_images_by_blog_id(1)
+    assert len(images) == 5 * len(formats)
+
+    for image in images:
+        assert image['format'] in formats
+        assert image['height'] == image['width'] // 2
+        assert image['filename'] == '1/{}-{}.{}'.format(
+            image['kind'], image['width'],
+            'jpg' if image['format'] == 'jpeg' else image['format'])
+        assert (upload_dir / image['filename']).is_file()
+
+    grouped = blog_images.group_variants(images)
+    assert [image['width'] for image in grouped['header']['jpeg']] == \
+        [480, 960, 1000]
+    assert [image['width'] for image in grouped['thumb']['jpeg']] == [160, 320]
+
+
+def test_generate_variants_small_original(tmp_path):
+    """
+    Test that generate_variants() never scales an image up, so that widths
+    larger than the original collapse into a single variant.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    upload_dir, original = build_original(tmp_path, build_image(200, 100))
+
+    images = blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                           str(original), str(upload_dir))
+
+    grouped = blog_images.group_variants(images)
+    assert [image['width'] for image in grouped['header']['jpeg']] == [200]
+    assert [image['width'] for image in grouped['thumb']['jpeg']] == [160, 200]
+
+
+def test_generate_variants_transparent(tmp_path):
+    """
+    Test that transparent areas of an original end up white, not black, in
+    the JPEG variants.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    image_module = pytest.importorskip('PIL.Image')
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    upload_dir, original = build_original(
+        tmp_path, build_image(200, 100, 'RGBA', (0, 0, 0, 0)))
+
+    images = blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                           str(original), str(upload_dir))
+
+    jpeg = blog_images.group_variants(images)['thumb']['jpeg'][0]
+    with image_module.open(upload_dir / jpeg['filename']) as variant:
+        assert min(variant.getpixel((10, 10))) > 240
+
+
+def test_generate_variants_not_an_image(tmp_path):
+    """
+    Test that generate_variants() returns False for an upload that is not an
+    image, deletes the original and records nothing.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    pytest.importorskip('PIL')
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    upload_dir, original = build_original(tmp_path, b'not an image at all')
+
+    assert blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                         str(original),
+                                         str(upload_dir)) is False
+    assert not original.exists()
+    assert db.get_images_by_blog_id(1) == []
+
+
+def test_generate_variants_icc_profile(tmp_path):
+    """
+    Test that the colour profile of an original is kept in every variant.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    image_module = pytest.importorskip('PIL.Image')
+    image_cms = pytest.importorskip('PIL.ImageCms')
+    profile = image_cms.ImageCmsProfile(
+        image_cms.createProfile('sRGB')).tobytes()
+    data = io.BytesIO()
+    image_module.new('RGB', (200, 100)).save(data, 'PNG', icc_profile=profile)
+
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    upload_dir, original = build_original(tmp_path, data.getvalue())
+
+    images = blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                           str(original), str(upload_dir))
+
+    assert images
+    for image in images:
+        with image_module.open(upload_dir / image['filename']) as variant:
+            assert variant.info.get('icc_profile') == profile
+
+
+def test_generate_variants_too_many_pixels(tmp_path):
+    """
+    Test that generate_variants() rejects an original with more than
+    MAX_PIXELS pixels, however small the file is, the same way as an upload
+    that is not an image.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    """
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    data = build_image(8000, 8000, '1', 0)
+    assert len(data) < 100 * 1024
+    upload_dir, original = build_original(tmp_path, data)
+
+    assert blog_images.generate_variants(str(build_db_path(tmp_path)), 1,
+                                         str(original),
+                                         str(upload_dir)) is False
+    assert not original.exists()
+    assert db.get_images_by_blog_id(1) == []
+
+
+def test_group_variants():
+    """
+    Test that group_variants() groups by kind and format, and that
+    group_variants_by_blog() groups by blog first.
+    """
+    images = [
+        {'blog_id': 1, 'kind': 'header', 'format': 'webp', 'width': 480},
+        {'blog_id': 1, 'kind': 'header', 'format': 'jpeg', 'width': 480},
+        {'blog_id': 1, 'kind': 'thumb', 'format': 'jpeg', 'width': 160},
+        {'blog_id': 2, 'kind': 'thumb', 'format': 'jpeg', 'width': 160},
+    ]
+
+    grouped = blog_images.group_variants(images[:3])
+    assert grouped == {'header': {'webp': [images[0]], 'jpeg': [images[1]]},
+                       'thumb': {'jpeg': [images[2]]}}
+
+    by_blog = blog_images.group_variants_by_blog(images)
+    assert by_blog[1] == grouped
+    assert by_blog[2] == {'thumb': {'jpeg': [images[3]]}}
+    assert blog_images.group_variants([]) == {}
+
+
+def test_srcset_filter(tmp_path, monkeypatch):
+    """
+    Test that the srcset template filter lists each variant's URL with its
+    width.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    :param monkeypatch: the pytest monkeypatch fixture
+    """
+    blog_app = build_app(tmp_path, monkeypatch)
+    images = [{'filename': '1/thumb-160.jpg', 'width': 160},
+              {'filename': '1/thumb-320.jpg', 'width': 320}]
+
+    with blog_app.app.test_request_context():
+        assert blog_app.srcset(images) == \
+            '/uploads/1/thumb-160.jpg 160w, /uploads/1/thumb-320.jpg 320w'
+        assert blog_app.srcset([]) == ''
+
+
+def test_addpost_with_image(tmp_path, monkeypatch):
+    """
+    Test that POST /addpost with a multipart image creates the post, and that
+    once the workers finish the post and index pages serve the variants
+    through srcset while the original stays private.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    :param monkeypatch: the pytest monkeypatch fixture
+    """
+    blog_app = build_app(tmp_path, monkeypatch)
+    assert BlogPost(build_db_path(tmp_path)).sign_up_entry('Giraffe', 'animal')
+    client = blog_app.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'Giraffe'
+
+    response = client.post('/addpost', data={
+        'title': 'stitle', 'subtitle': 'ssubtitle', 'content': 'scontent',
+        'image': (io.BytesIO(build_image(1000, 500)), 'photo.png')},
+        content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    blog_app.image_workers.shutdown(wait=True)
+
+    post_page = client.get('/post/1').get_data(as_text=True)
+    assert '/uploads/1/header-960.jpg 960w' in post_page
+    assert 'post-bg.jpg' not in post_page
+
+    index_page = client.get('/index').get_data(as_text=True)
+    assert '/uploads/1/thumb-160.jpg 160w' in index_page
+    assert 'height="80"' in index_page
+
+    response = client.get('/uploads/1/thumb-160.jpg')
+    assert response.status_code == 200
+    assert response.cache_control.max_age == \
+        blog_app.app.config['UPLOAD_MAX_AGE']
+    original = [name for name in os.listdir(tmp_path / 'uploads' / '1')
+                if name.startswith('original-')]
+    assert len(original) == 1
+    assert client.get('/uploads/1/' + original[0]).status_code == 404
+
+
+def test_render_with_partial_variants(tmp_path, monkeypatch):
+    """
+    Test that the post and index pages still render, with the default
+    header and no thumbnail, when a post has WebP variants but no JPEG ones.
+
+    :param tmp_path: a Path object representing the path to the temporary
+     directory created via the pytest tmp_path fixture
+    :param monkeypatch: the pytest monkeypatch fixture
+    """
+    blog_app = build_app(tmp_path, monkeypatch)
+    db = BlogPost(build_db_path(tmp_path))
+    assert db.sign_up_entry('Giraffe', 'animal')
+    assert db.insert_blog('stitle', 'ssubtitle', 'Giraffe', 'scontent')
+    assert db.insert_images(1, [('header', 'webp', 480, 240,
+                                 '1/header-480.webp'),
+                                ('thumb', 'webp', 160, 80,
+                                 '1/thumb-160.webp')])
+    client = blog_app.app.test_client()
+
+    response = client.get('/post/1')
+    assert response.status_code == 200
+    assert 'post-bg.jpg' in response.get_data(as_text=True)
+
+    response = client.get('/index')
+    assert response.status_code == 200
+    assert '<picture>' not in response.get_data(as_text=True)